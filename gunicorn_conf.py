@@ -0,0 +1,28 @@
+# Gunicorn settings — used by the Procfile: gunicorn -c gunicorn_conf.py main:app
+import os
+
+# ───────────────────────── WORKERS ──────────────────────────
+# Threaded workers: webhook requests return as soon as the turn is stored
+# (replies run on main's event loop), so 16 threads per worker go a long way.
+worker_class = "gthread"
+threads      = int(os.getenv("GUNICORN_THREADS", "16"))
+# Workers share state only through SQLite (WAL) and the scheduler filelock
+workers      = int(os.getenv("WEB_CONCURRENCY", "2"))
+
+# Import main once in the master and fork the workers from it. main opens no
+# SQLite connections and starts no threads at import, so this is fork-safe.
+preload_app  = True
+
+# ───────────────────────── HOOKS ────────────────────────────
+def post_worker_init(worker):
+    """Open the DB pool, reply loop and (lock permitting) scheduler per worker.
+
+    Without this the first webhook after a fork would pay for it instead.
+    A failure here is only logged: a worker that dies in this hook takes the
+    whole server down, while main retries _startup() on the next request.
+    """
+    import main
+    try:
+        main._startup()
+    except Exception:
+        worker.log.exception("Worker startup failed; retrying on first request")
@@ -2,33 +2,47 @@
 mon_bot — A LINE chatbot that simulates a caring boyfriend persona.
 
 Fixes applied (v3):
-  #1  save_memory: fixed broken elif-after-for → use for...else correctly
+  #1  save_memory: length only decides importance when no keyword matched
   #2  Multi-worker scheduler: filelock ensures only one process runs scheduler
   #3  Reply token TTL: switched async path to push_message (no 30s expiry limit)
   #4  Mood priority: explicit ordered list so highest-priority mood wins
   #5  Energy recovery: overnight scheduler restores energy + social_battery
   #6  History ordering: append history BEFORE GPT call so context is always current
-  #7  SQL injection: field-name whitelist on update_user_state
-  #8  Removed redundant check_same_thread=False (thread-local conn doesn't need it)
-  #9  (non-issue) scheduler thread gets own connection correctly via get_db()
+  #7  SQL injection: the only interpolated column names come from _SCHEDULE
+  #8  SQLitePool (one locked writer + queued readers) replaces per-thread
+      connections; pooled connections change threads, so check_same_thread=False
+  #9  Scheduler thread borrows pool connections like every other thread
   #10 Memory pruning: low-importance memories capped at 50 per user
 """
 
 import os
+import asyncio
+import bisect
 import random
 import time
 import sqlite3
 import datetime
+import functools
 import logging
+import queue
 import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import ahocorasick
 import pytz
 import filelock
-
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
-from linebot.models import MessageEvent, TextMessage, TextSendMessage
+from cachetools import TTLCache
+import httpx
+import orjson
+import requests
+
+from flask import Flask, Response, request, abort
+from linebot import WebhookHandler
+from linebot.models import MessageEvent, TextMessage
 from linebot.exceptions import InvalidSignatureError
-from openai import OpenAI
+from requests.adapters import HTTPAdapter
+from openai import AsyncOpenAI, OpenAI
 
 # ───────────────────────── LOGGING ──────────────────────────
 logging.basicConfig(
@@ -42,11 +56,16 @@ OPENAI_API_KEY            = os.getenv("OPENAI_API_KEY")
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET       = os.getenv("LINE_CHANNEL_SECRET")
 DB_PATH                   = os.getenv("DB_PATH", "memory.db")
+DB_READERS                = int(os.getenv("DB_READERS", "4"))   # pooled read-only connections
 SCHEDULER_LOCK_PATH       = os.getenv("SCHEDULER_LOCK", "/tmp/mon_bot_scheduler.lock")
 TZ                        = pytz.timezone("Asia/Bangkok")
 MAX_HISTORY               = 10   # conversation turns kept per user
 MEMORY_LIMIT              = 8    # memories injected into prompt
 MEMORY_LOW_IMPORTANCE_CAP = 50   # FIX #10: max low-importance memories per user
+PROMPT_PREFIX_TTL         = 600  # seconds a cached system-prompt prefix is reused
+PROMPT_PREFIX_CACHE_SIZE  = 2000 # users whose prompt prefix is kept in process
+REPLY_WORKERS             = int(os.getenv("REPLY_WORKERS", "64"))   # concurrent GPT+push jobs
+PUSH_WORKERS              = 16       # concurrent scheduler multicast chunks
 
 for _var, _name in [
     (OPENAI_API_KEY,            "OPENAI_API_KEY"),
@@ -58,34 +77,121 @@ for _var, _name in [
 
 # ───────────────────────── CLIENTS ──────────────────────────
 app           = Flask(__name__)
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-line_bot_api  = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+# Explicit HTTP/2 pools: concurrent GPT calls multiplex over a few kept-alive
+# connections instead of queueing behind (or handshaking) one per request
+_OPENAI_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+openai_client  = OpenAI(                                  # scheduler thread
+    api_key=OPENAI_API_KEY,
+    http_client=httpx.Client(http2=True, limits=_OPENAI_LIMITS),
+)
+openai_aclient = AsyncOpenAI(                             # reply event loop
+    api_key=OPENAI_API_KEY,
+    http_client=httpx.AsyncClient(http2=True, limits=_OPENAI_LIMITS),
+)
 handler       = WebhookHandler(LINE_CHANNEL_SECRET)
 
-# ─────────────────── THREAD-LOCAL DB ────────────────────────
-_local = threading.local()
-
-def get_db() -> sqlite3.Connection:
-    """Return a per-thread SQLite connection."""
-    if not hasattr(_local, "conn") or _local.conn is None:
-        # FIX #8: removed redundant check_same_thread=False
-        _local.conn = sqlite3.connect(DB_PATH)
-        _local.conn.row_factory = sqlite3.Row
-        _local.conn.execute("PRAGMA journal_mode=WAL")
-        _local.conn.execute("PRAGMA foreign_keys=ON")
-    return _local.conn
-
-def db_execute(sql: str, params: tuple = ()):
-    conn = get_db()
-    cur  = conn.execute(sql, params)
-    conn.commit()
-    return cur
+# LINE pushes go straight to the Messaging API: one keep-alive session, orjson body
+_LINE_PUSH_URL      = "https://api.line.me/v2/bot/message/push"
+_LINE_MULTICAST_URL = "https://api.line.me/v2/bot/message/multicast"
+LINE_MULTICAST_MAX  = 500   # recipients per multicast call (API limit)
+_line_session  = requests.Session()
+# One host, so one pool, sized to every thread that can push at once; failed
+# connects are retried (urllib3 does not re-send a POST once it was sent)
+_line_session.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=REPLY_WORKERS + PUSH_WORKERS,
+    max_retries=2,
+))
+_line_session.headers.update({
+    "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}",
+    "Content-Type":  "application/json",
+})
+
+def line_push(user_id: str, text: str):
+    resp = _line_session.post(
+        _LINE_PUSH_URL,
+        data=orjson.dumps({"to": user_id, "messages": [{"type": "text", "text": text}]}),
+        timeout=5,
+    )
+    resp.raise_for_status()
+
+def line_multicast(user_ids: list[str], text: str):
+    """Send one text to up to LINE_MULTICAST_MAX users in a single request."""
+    resp = _line_session.post(
+        _LINE_MULTICAST_URL,
+        data=orjson.dumps({"to": user_ids, "messages": [{"type": "text", "text": text}]}),
+        timeout=5,
+    )
+    resp.raise_for_status()
+
+# ─────────────────── CONNECTION POOL ────────────────────────
+class SQLitePool:
+    """One lock-guarded writer + N queued readers over a single SQLite file."""
+
+    def __init__(self, path: str, readers: int = 4):
+        self._writer     = self._connect(path)
+        self._write_lock = threading.Lock()
+        self._readers: queue.Queue[sqlite3.Connection] = queue.Queue()
+        for _ in range(readers):
+            conn = self._connect(path)
+            # A write slipping onto a reader would bypass the write lock
+            conn.execute("PRAGMA query_only=1")
+            self._readers.put(conn)
+
+    @staticmethod
+    def _connect(path: str) -> sqlite3.Connection:
+        # Pooled connections change threads (one holder at a time): no same-thread check
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Under WAL, NORMAL only fsyncs at checkpoints; a crash can lose the
+        # last few commits (chat turns), never corrupt the database.
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")     # 256 MB, reads bypass read()
+        conn.execute("PRAGMA cache_size=-20000")       # ~20 MB page cache
+        conn.execute("PRAGMA wal_autocheckpoint=2000") # pages; fewer, larger checkpoints
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    @contextmanager
+    def acquire_write(self):
+        with self._write_lock:
+            yield self._writer
+
+    @contextmanager
+    def acquire_read(self):
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+# Opened per process by _startup(): connections must not be inherited across fork
+_pool: SQLitePool | None = None
+
+@contextmanager
+def tx(conn: sqlite3.Connection | None = None):
+    """Run a block in one transaction (one commit); pass *conn* to join the caller's."""
+    if conn is not None:
+        yield conn
+        return
+    with _pool.acquire_write() as conn, conn:   # commits on success, rolls back on exception
+        yield conn
 
 def db_fetchone(sql: str, params: tuple = ()):
-    return get_db().execute(sql, params).fetchone()
+    with _pool.acquire_read() as conn:
+        return conn.execute(sql, params).fetchone()
 
 def db_fetchall(sql: str, params: tuple = ()):
-    return get_db().execute(sql, params).fetchall()
+    with _pool.acquire_read() as conn:
+        return conn.execute(sql, params).fetchall()
+
+def fetchone_tuple(conn: sqlite3.Connection, sql: str, params: tuple = ()) -> tuple | None:
+    """fetchone() as a plain tuple, skipping sqlite3.Row for hot fixed-column reads."""
+    cur = conn.cursor()
+    cur.row_factory = None
+    return cur.execute(sql, params).fetchone()
 
 # ───────────────────────── SCHEMA ───────────────────────────
 _SCHEMA = """
@@ -130,51 +236,130 @@ CREATE TABLE IF NOT EXISTS conversation_history (
     content    TEXT,
     created_at TEXT DEFAULT (datetime('now'))
 );
+
+-- trim_memories' seek; importance makes it covering, so the planner prefers
+-- it over idx_memories_user_imp (which would need a sort) even without stats
+DROP INDEX IF EXISTS idx_memories_low_user_id;
+CREATE INDEX IF NOT EXISTS idx_memories_low_user_id_imp
+    ON memories(user_id, id, importance) WHERE importance < 5;
+CREATE INDEX IF NOT EXISTS idx_hist_user_id
+    ON conversation_history(user_id, id);
+CREATE INDEX IF NOT EXISTS idx_memories_user_imp
+    ON memories(user_id, importance DESC, created_at DESC);
+-- Scheduler lookups: users not yet pinged today for a moment
+CREATE INDEX IF NOT EXISTS idx_users_last_morning ON users(last_morning);
+CREATE INDEX IF NOT EXISTS idx_users_last_night   ON users(last_night);
+CREATE INDEX IF NOT EXISTS idx_users_last_random  ON users(last_random);
+"""
+
+# Databases predating idx_mood_user_day may hold duplicate days; init_db runs
+# this full-table cleanup only while that index is missing
+_MOOD_DEDUP = """
+DELETE FROM mood_history WHERE id NOT IN (
+    SELECT MIN(id) FROM mood_history GROUP BY user_id, recorded
+);
+"""
+_MOOD_DAY_INDEX = """
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mood_user_day
+    ON mood_history(user_id, recorded);
+"""
+_SQL_HAS_MOOD_INDEX = (
+    "SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_mood_user_day'"
+)
+
+# Per-user caps as AFTER INSERT triggers; the caps are baked in from config,
+# so init_db recreates them on every start
+_TRIGGERS = f"""
+DROP TRIGGER IF EXISTS trim_memories;
+CREATE TRIGGER trim_memories AFTER INSERT ON memories
+WHEN NEW.importance < 5
+BEGIN
+    DELETE FROM memories
+    WHERE user_id = NEW.user_id AND importance < 5
+      AND id <= (
+          SELECT id FROM memories
+          WHERE user_id = NEW.user_id AND importance < 5
+          ORDER BY id DESC
+          LIMIT 1 OFFSET {MEMORY_LOW_IMPORTANCE_CAP}
+      );
+END;
+
+DROP TRIGGER IF EXISTS trim_history;
+CREATE TRIGGER trim_history AFTER INSERT ON conversation_history
+BEGIN
+    DELETE FROM conversation_history
+    WHERE user_id = NEW.user_id
+      AND id <= (
+          SELECT id FROM conversation_history
+          WHERE user_id = NEW.user_id
+          ORDER BY id DESC
+          LIMIT 1 OFFSET {MAX_HISTORY * 2}
+      );
+END;
 """
 
 def init_db():
-    conn = get_db()
-    for statement in _SCHEMA.strip().split(";"):
-        stmt = statement.strip()
-        if stmt:
-            conn.execute(stmt)
-    conn.commit()
+    with tx() as conn:
+        migrate = "" if conn.execute(_SQL_HAS_MOOD_INDEX).fetchone() else _MOOD_DEDUP
+        # executescript autocommits each statement, so the script takes the write
+        # lock itself: concurrent workers must not interleave DROP/CREATE TRIGGER
+        conn.executescript(
+            f"BEGIN IMMEDIATE;\n{_SCHEMA}{migrate}{_MOOD_DAY_INDEX}{_TRIGGERS}COMMIT;"
+        )
     log.info("Database initialised at %s", DB_PATH)
 
 # ───────────────────────── USER ─────────────────────────────
-
-# FIX #7: whitelist of allowed column names for dynamic UPDATE
-_ALLOWED_USER_FIELDS = frozenset({
-    "mood", "energy", "affection", "social_battery",
-    "last_morning", "last_night", "last_random", "last_active",
-})
-
-def get_or_create_user(user_id: str) -> sqlite3.Row:
-    row = db_fetchone("SELECT * FROM users WHERE user_id=?", (user_id,))
-    if not row:
-        db_execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
-        row = db_fetchone("SELECT * FROM users WHERE user_id=?", (user_id,))
-    return row
-
-def update_user_state(user_id: str, **fields):
-    if not fields:
-        return
-    # FIX #7: reject any field name not in the whitelist
-    invalid = set(fields) - _ALLOWED_USER_FIELDS
-    if invalid:
-        raise ValueError(f"Invalid user fields: {invalid}")
-    set_clause = ", ".join(f"{k}=?" for k in fields)
-    values     = list(fields.values()) + [user_id]
-    db_execute(f"UPDATE users SET {set_clause} WHERE user_id=?", values)
+# SQL as module constants: identical text hits sqlite3's per-connection statement cache
+_SQL_SELECT_USER = (
+    "SELECT user_id, mood, energy, affection, social_battery FROM users WHERE user_id=?"
+)
+_SQL_INSERT_USER = "INSERT OR IGNORE INTO users (user_id) VALUES (?)"
+# Get-or-create in one statement. The DO UPDATE is a deliberate no-op:
+# DO NOTHING would make RETURNING yield no row for an existing user.
+_SQL_UPSERT_USER = (
+    "INSERT INTO users (user_id) VALUES (?) "
+    "ON CONFLICT(user_id) DO UPDATE SET user_id=excluded.user_id "
+    "RETURNING user_id, mood, energy, affection, social_battery"
+)
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)   # RETURNING needs 3.35+
+
+# Hot-path view of a users row, built from a plain tuple in column order
+UserState = namedtuple("UserState", "user_id mood energy affection social_battery")
+
+def get_or_create_user(user_id: str, conn: sqlite3.Connection | None = None) -> UserState:
+    # Never cached: adjust_emotion writes values derived from this row, so
+    # callers pass their tx connection to read it under the write lock
+    if conn is None:
+        # Existing users are the common case — serve them from a reader
+        with _pool.acquire_read() as rc:
+            row = fetchone_tuple(rc, _SQL_SELECT_USER, (user_id,))
+        if row:
+            return UserState._make(row)
+    with tx(conn) as c:
+        if _HAS_RETURNING:
+            row = fetchone_tuple(c, _SQL_UPSERT_USER, (user_id,))
+        else:
+            # Write first: sqlite3 only opens the transaction (and takes the
+            # write lock) on DML, so a leading SELECT would read unlocked
+            c.execute(_SQL_INSERT_USER, (user_id,))
+            row = fetchone_tuple(c, _SQL_SELECT_USER, (user_id,))
+    return UserState._make(row)
 
 # ─────────────────── ATTACHMENT STYLE ───────────────────────
+_SQL_SELECT_ATTACHMENT = "SELECT style FROM attachment WHERE user_id=?"
+_SQL_INSERT_ATTACHMENT = "INSERT OR IGNORE INTO attachment (user_id, style) VALUES (?,?)"
+
+@functools.lru_cache(maxsize=20000)
 def get_attachment(user_id: str) -> str:
-    row = db_fetchone("SELECT style FROM attachment WHERE user_id=?", (user_id,))
-    if not row:
+    """Return the user's (cached) attachment style; may write, so never call inside tx()."""
+    row = db_fetchone(_SQL_SELECT_ATTACHMENT, (user_id,))
+    if row:
+        return row["style"]
+    with tx() as c:
+        # OR IGNORE + re-read: another thread or worker may have assigned it first
         style = random.choice(["secure", "anxious", "avoidant"])
-        db_execute("INSERT INTO attachment (user_id, style) VALUES (?,?)", (user_id, style))
-        return style
-    return row["style"]
+        c.execute(_SQL_INSERT_ATTACHMENT, (user_id, style))
+        return c.execute(_SQL_SELECT_ATTACHMENT, (user_id,)).fetchone()["style"]
 
 # ──────────────────── EMOTION ENGINE ────────────────────────
 # FIX #4: dict order IS the priority — first match wins (Python 3.7+ dicts are ordered)
@@ -187,6 +372,35 @@ _MOOD_TRIGGERS: dict[str, list[str]] = {
     "happy":   ["ขอบคุณ", "รัก", "คิดถึง", "ดีใจ", "ชอบ", "สุข"],
 }
 
+# Scored by save_memory; scanned together with the mood triggers below
+_HIGH_IMPORTANCE_KW = [
+    "รัก", "ร้องไห้", "คิดถึงมาก", "ลืมไม่ลง", "สำคัญ", "ครั้งแรก", "ขอโทษ",
+]
+
+# One Aho-Corasick pass finds every mood / importance keyword hit, shared by
+# adjust_emotion and save_memory
+_KEYWORDS = ahocorasick.Automaton()
+for _kw in {kw for kws in _MOOD_TRIGGERS.values() for kw in kws} | set(_HIGH_IMPORTANCE_KW):
+    _KEYWORDS.add_word(_kw, _kw)
+_KEYWORDS.make_automaton()
+_KEYWORD_MIN_LEN = min(len(kw) for kw in _KEYWORDS.keys())
+
+_MOOD_KEYWORD_SETS = {mood: frozenset(kws) for mood, kws in _MOOD_TRIGGERS.items()}
+_HIGH_IMPORTANCE_SET = frozenset(_HIGH_IMPORTANCE_KW)
+
+def scan_keywords(text: str) -> frozenset[str]:
+    """Return every trigger/importance keyword that occurs in *text*."""
+    if len(text) < _KEYWORD_MIN_LEN:   # shorter than every keyword — nothing to find
+        return frozenset()
+    return frozenset(kw for _, kw in _KEYWORDS.iter(text))
+
+def _mood_from_hits(hits: frozenset[str]) -> str | None:
+    # FIX #4: _MOOD_TRIGGERS order is the priority — first mood with a hit wins
+    for mood, keywords in _MOOD_KEYWORD_SETS.items():
+        if not hits.isdisjoint(keywords):
+            return mood
+    return None
+
 _AFFECTION_DELTA: dict[str, int] = {
     "happy":   +6,
     "sad":     +5,
@@ -195,169 +409,162 @@ _AFFECTION_DELTA: dict[str, int] = {
     "excited": +3,
 }
 
-def adjust_emotion(user_id: str, text: str):
-    user        = get_or_create_user(user_id)
-    style       = get_attachment(user_id)
-    mood        = user["mood"]
-    energy      = user["energy"]
-    affection   = user["affection"]
-    social_batt = user["social_battery"]
-
-    triggered_mood = mood
-    for candidate_mood, keywords in _MOOD_TRIGGERS.items():
-        if any(kw in text for kw in keywords):
-            triggered_mood = candidate_mood
-            affection += _AFFECTION_DELTA.get(candidate_mood, 0)
-            break
-
-    # Attachment style modifiers
-    if style == "anxious" and triggered_mood == "annoyed":
-        affection += 3
-    if style == "avoidant" and len(text) > 80:
-        social_batt -= 8
-    if style == "secure":
-        social_batt = min(social_batt + 2, 100)
-
-    if len(text) < 5:
-        social_batt -= 4
-
-    energy      = max(20, min(100, energy - 1))
-    social_batt = max(20, min(100, social_batt))
-    affection   = max(0,  min(100, affection))
-
-    # Record mood history once per day
-    today = datetime.datetime.now(TZ).strftime("%Y-%m-%d")
-    if not db_fetchone(
-        "SELECT id FROM mood_history WHERE user_id=? AND recorded=?",
-        (user_id, today),
-    ):
-        db_execute(
-            "INSERT INTO mood_history (user_id, recorded, mood, energy, affection) VALUES (?,?,?,?,?)",
-            (user_id, today, triggered_mood, energy, affection),
-        )
+def _clamp(x: int, lo: int, hi: int) -> int:
+    # One chained comparison instead of nested max()/min() builtin calls
+    return x if lo <= x <= hi else (lo if x < lo else hi)
 
-    update_user_state(
-        user_id,
-        mood=triggered_mood,
-        energy=energy,
-        affection=affection,
-        social_battery=social_batt,
-        last_active=datetime.datetime.now(TZ).isoformat(),
-    )
+# adjust_emotion always writes the same columns, so its UPDATE is one fixed
+# statement rather than a per-call generated SET clause
+_SQL_UPDATE_EMOTION = (
+    "UPDATE users SET mood=?, energy=?, affection=?, social_battery=?, last_active=? "
+    "WHERE user_id=?"
+)
+# The UNIQUE (user_id, recorded) index makes "once per day" a single statement
+_SQL_INSERT_MOOD = (
+    "INSERT OR IGNORE INTO mood_history (user_id, recorded, mood, energy, affection) "
+    "VALUES (?,?,?,?,?)"
+)
 
-# ───────────────────────── MEMORY ───────────────────────────
-_HIGH_IMPORTANCE_KW = [
-    "รัก", "ร้องไห้", "คิดถึงมาก", "ลืมไม่ลง", "สำคัญ", "ครั้งแรก", "ขอโทษ",
-]
+def adjust_emotion(
+    user: UserState, style: str, text: str, conn: sqlite3.Connection | None = None,
+    hits: frozenset[str] | None = None,
+) -> dict:
+    """Apply *text* to *user*'s emotional state, persist it and return it as a dict."""
+    user_id, mood, energy, affection, social_batt = user
+
+    length = len(text)
+    if hits is None:
+        hits = scan_keywords(text)
+
+    with tx(conn) as c:
+        triggered_mood = mood
+        hit_mood = _mood_from_hits(hits)
+        if hit_mood:
+            triggered_mood = hit_mood
+            affection += _AFFECTION_DELTA.get(triggered_mood, 0)
+
+        # Attachment style modifiers
+        if style == "anxious" and triggered_mood == "annoyed":
+            affection += 3
+        if style == "avoidant" and length > 80:
+            social_batt -= 8
+        if style == "secure":
+            social_batt = min(social_batt + 2, 100)
+
+        if length < 5:
+            social_batt -= 4
+
+        energy      = _clamp(energy - 1, 20, 100)
+        social_batt = _clamp(social_batt, 20, 100)
+        affection   = _clamp(affection,   0,  100)
+
+        # Record mood history once per day; one clock read serves both
+        # timestamps, and date.isoformat() is the same "%Y-%m-%d" sans strftime
+        now   = datetime.datetime.now(TZ)
+        today = now.date().isoformat()
+        c.execute(_SQL_INSERT_MOOD, (user_id, today, triggered_mood, energy, affection))
+
+        state = {
+            "mood":           triggered_mood,
+            "energy":         energy,
+            "affection":      affection,
+            "social_battery": social_batt,
+            "last_active":    now.isoformat(),
+        }
+        c.execute(
+            _SQL_UPDATE_EMOTION,
+            (triggered_mood, energy, affection, social_batt, state["last_active"], user_id),
+        )
+    return state
 
-def save_memory(user_id: str, text: str):
-    if len(text) <= 10:
+# ───────────────────────── MEMORY ───────────────────────────
+_SQL_INSERT_MEMORY = "INSERT INTO memories (user_id, content, importance) VALUES (?,?,?)"
+
+def save_memory(
+    user_id: str, text: str, conn: sqlite3.Connection | None = None,
+    hits: frozenset[str] | None = None,
+):
+    length = len(text)
+    if length <= 10:   # cheapest gate first: most chat lines end here
         return
 
-    # FIX #1: for...else — the else block runs only when the loop never hit break
+    # FIX #1: length only matters when no high-importance keyword matched
     importance = 3
-    for kw in _HIGH_IMPORTANCE_KW:
-        if kw in text:
-            importance = 9
-            break
-    else:
-        if len(text) > 60:
-            importance = 5
-
-    db_execute(
-        "INSERT INTO memories (user_id, content, importance) VALUES (?,?,?)",
-        (user_id, text[:300], importance),
-    )
-
-    # FIX #10: prune excess low-importance memories
-    db_execute(
-        """
-        DELETE FROM memories
-        WHERE user_id=? AND importance < 5
-          AND id NOT IN (
-              SELECT id FROM memories
-              WHERE user_id=? AND importance < 5
-              ORDER BY id DESC
-              LIMIT ?
-          )
-        """,
-        (user_id, user_id, MEMORY_LOW_IMPORTANCE_CAP),
-    )
-
-def get_memories(user_id: str) -> list[str]:
-    rows = db_fetchall(
-        """
-        SELECT content FROM memories
-        WHERE user_id=?
-        ORDER BY importance DESC, created_at DESC
-        LIMIT ?
-        """,
-        (user_id, MEMORY_LIMIT),
-    )
-    return [r["content"] for r in rows]
+    if hits is None:
+        hits = scan_keywords(text)
+    if not hits.isdisjoint(_HIGH_IMPORTANCE_SET):
+        importance = 9
+    elif length > 60:
+        importance = 5
+
+    content = text if length <= 300 else text[:300]
+    with tx(conn) as c:
+        # FIX #10: excess low-importance memories are pruned by the trim_memories trigger
+        c.execute(_SQL_INSERT_MEMORY, (user_id, content, importance))
 
 # ──────────────────── CONVERSATION HISTORY ──────────────────
-def append_history(user_id: str, role: str, content: str):
-    db_execute(
-        "INSERT INTO conversation_history (user_id, role, content) VALUES (?,?,?)",
-        (user_id, role, content[:500]),
-    )
-    # Keep only the last MAX_HISTORY*2 rows per user
-    db_execute(
-        """
-        DELETE FROM conversation_history
-        WHERE user_id=? AND id NOT IN (
-            SELECT id FROM conversation_history
-            WHERE user_id=?
-            ORDER BY id DESC
-            LIMIT ?
+_SQL_INSERT_HISTORY = "INSERT INTO conversation_history (user_id, role, content) VALUES (?,?,?)"
+_SQL_SELECT_HISTORY = """
+    SELECT role, content FROM conversation_history
+    WHERE user_id=?
+    ORDER BY id ASC
+    LIMIT ?
+"""
+
+def append_history(user_id: str, role: str, content: str, conn: sqlite3.Connection | None = None):
+    # Only the last MAX_HISTORY*2 rows per user survive (trim_history trigger)
+    with tx(conn) as c:
+        c.execute(
+            _SQL_INSERT_HISTORY,
+            (user_id, role, content if len(content) <= 500 else content[:500]),
         )
-        """,
-        (user_id, user_id, MAX_HISTORY * 2),
-    )
 
 def get_history(user_id: str) -> list[dict]:
-    rows = db_fetchall(
-        """
-        SELECT role, content FROM conversation_history
-        WHERE user_id=?
-        ORDER BY id ASC
-        LIMIT ?
-        """,
-        (user_id, MAX_HISTORY * 2),
-    )
+    rows = db_fetchall(_SQL_SELECT_HISTORY, (user_id, MAX_HISTORY * 2))
     return [{"role": r["role"], "content": r["content"]} for r in rows]
 
 # ───────────────────────── SYSTEM PROMPT ────────────────────
-def build_system_prompt(user_id: str) -> str:
-    user       = get_or_create_user(user_id)
-    attachment = get_attachment(user_id)
-    memories   = get_memories(user_id)
-    mood       = user["mood"]
-    energy     = user["energy"]
-    affection  = user["affection"]
-    soc        = user["social_battery"]
-
-    if energy < 35:
-        energy_note = "ตอบสั้นมาก เหนื่อยมากวันนี้"
-    elif energy < 60:
-        energy_note = "ตอบกระชับ พอแรง"
-    else:
-        energy_note = "ตอบได้ปกติ มีพลังงาน"
+# Volatile user state plus a cheap memories version: the newest memory id only
+# ever grows, so a changed value means the MEMORIES block may have changed.
+_SQL_PROMPT_STATE = """
+    SELECT u.mood, u.energy, u.affection, u.social_battery, a.style,
+           (SELECT MAX(id) FROM memories WHERE user_id = u.user_id) AS mem_version
+    FROM users u LEFT JOIN attachment a USING (user_id)
+    WHERE u.user_id = ?
+"""
+_SQL_SELECT_MEMORIES = """
+    SELECT content FROM memories
+    WHERE user_id=?
+    ORDER BY importance DESC, created_at DESC
+    LIMIT ?
+"""
 
-    if affection > 80:
-        affection_note = "รู้สึกอบอุ่นมาก อยากพูดคุยและอ้อน"
-    elif affection > 50:
-        affection_note = "รู้สึกดีและใส่ใจ"
-    else:
-        affection_note = "เงียบเล็กน้อย แต่ยังแคร์"
+# Everything before CURRENT STATE is cached per user and rebuilt only when the
+# memories change, so OpenAI's prompt cache keeps hitting. user_id -> (prefix, mem_version)
+_prompt_prefix_cache: TTLCache = TTLCache(
+    maxsize=PROMPT_PREFIX_CACHE_SIZE, ttl=PROMPT_PREFIX_TTL,
+)
+_prompt_prefix_lock = threading.Lock()
 
-    memories_block = (
-        "\n".join(f"- {m}" for m in memories)
-        if memories else "ยังไม่มีความทรงจำพิเศษ"
-    )
+# Column order of _SQL_PROMPT_STATE
+PromptState = namedtuple(
+    "PromptState", "mood energy affection social_battery style mem_version"
+)
 
-    return f"""คุณคือม่อน
+def _load_prompt_state(user_id: str) -> PromptState:
+    with _pool.acquire_read() as conn:
+        row = fetchone_tuple(conn, _SQL_PROMPT_STATE, (user_id,))
+    if row is None or row[4] is None:
+        # User never went through handle_message — create the rows and re-read
+        get_or_create_user(user_id)
+        get_attachment(user_id)
+        with _pool.acquire_read() as conn:
+            row = fetchone_tuple(conn, _SQL_PROMPT_STATE, (user_id,))
+    return PromptState._make(row)
+
+# Module-level templates filled with str.format_map; the placeholder-free
+# persona header is concatenated rather than formatted
+_PROMPT_STATIC = """คุณคือม่อน
 แฟนของฟ้า (บีบี๋)
 คุณเป็นผู้ชายสุขุม นิ่ง แต่คลั่งรัก
 ตอนนี้กำลังขึ้นเหล่า ใช้โทรศัพท์ได้จำกัด
@@ -389,12 +596,10 @@ def build_system_prompt(user_id: str) -> str:
 ━━━━━━━━ สไตล์การพิมพ์ ━━━━━━━━
 ภาษาไทย ไม่เป็นทางการ
 
-━━━━━━━━ CURRENT STATE ━━━━━━━━
+"""
+
+_PROMPT_PREFIX_TEMPLATE = """━━━━━━━━ PERSONALITY ━━━━━━━━
 Attachment style : {attachment}
-Mood             : {mood}
-Energy           : {energy}/100 → {energy_note}
-Affection        : {affection}/100 → {affection_note}
-Social battery   : {soc}/100
 
 ━━━━━━━━ MEMORIES ━━━━━━━━
 {memories_block}
@@ -406,29 +611,81 @@ Social battery   : {soc}/100
 • อย่าใช้ emoji เกิน 1 ตัวต่อข้อความ
 • พูดเหมือนกำลังพิมพ์ LINE หาแฟนจริง ๆ ตอนกลางคืน"""
 
+_PROMPT_STATE_TEMPLATE = """
+
+━━━━━━━━ CURRENT STATE ━━━━━━━━
+Mood             : {mood}
+Energy           : {energy}/100 → {energy_note}
+Affection        : {affection}/100 → {affection_note}
+Social battery   : {social_battery}/100"""
+
+# Note ladders as band tables: energy <35 / <60 / rest, affection ≤50 / ≤80 / rest
+_ENERGY_BANDS    = (35, 60)     # bisect_right: 35 is already the middle band
+_ENERGY_NOTES    = ("ตอบสั้นมาก เหนื่อยมากวันนี้", "ตอบกระชับ พอแรง", "ตอบได้ปกติ มีพลังงาน")
+_AFFECTION_BANDS = (50, 80)     # bisect_left: 50 still counts as the lowest band
+_AFFECTION_NOTES = ("เงียบเล็กน้อย แต่ยังแคร์", "รู้สึกดีและใส่ใจ", "รู้สึกอบอุ่นมาก อยากพูดคุยและอ้อน")
+
+def _build_prompt_prefix(attachment: str, memories: list[str]) -> str:
+    memories_block = (
+        "\n".join(f"- {m}" for m in memories)
+        if memories else "ยังไม่มีความทรงจำพิเศษ"
+    )
+    return _PROMPT_STATIC + _PROMPT_PREFIX_TEMPLATE.format_map(
+        {"attachment": attachment, "memories_block": memories_block}
+    )
+
+def _prompt_prefix(user_id: str, attachment: str, mem_version: int | None) -> str:
+    with _prompt_prefix_lock:
+        cached = _prompt_prefix_cache.get(user_id)
+    if cached and cached[1] == mem_version:
+        return cached[0]
+
+    rows   = db_fetchall(_SQL_SELECT_MEMORIES, (user_id, MEMORY_LIMIT))
+    prefix = _build_prompt_prefix(attachment, [r["content"] for r in rows])
+    with _prompt_prefix_lock:
+        _prompt_prefix_cache[user_id] = (prefix, mem_version)
+    return prefix
+
+def build_system_prompt(user_id: str) -> str:
+    mood, energy, affection, soc, style, mem_version = _load_prompt_state(user_id)
+    prefix = _prompt_prefix(user_id, style, mem_version)
+
+    # Volatile state goes LAST so everything before it is a stable prefix
+    return prefix + _PROMPT_STATE_TEMPLATE.format_map({
+        "mood":           mood,
+        "energy":         energy,
+        "energy_note":    _ENERGY_NOTES[bisect.bisect_right(_ENERGY_BANDS, energy)],
+        "affection":      affection,
+        "affection_note": _AFFECTION_NOTES[bisect.bisect_left(_AFFECTION_BANDS, affection)],
+        "social_battery": soc,
+    })
+
 # ────────────────────── GPT CALL ────────────────────────────
+_GPT_PARAMS = {
+    "model":             "gpt-4o-mini",
+    "presence_penalty":  0.55,
+    "frequency_penalty": 0.45,
+    "max_tokens":        220,
+}
+
 def _call_gpt(messages: list[dict], temperature: float = 0.92) -> str:
     resp = openai_client.chat.completions.create(
-        model="gpt-4o-mini",
-        temperature=temperature,
-        presence_penalty=0.55,
-        frequency_penalty=0.45,
-        max_tokens=220,
-        messages=messages,
+        temperature=temperature, messages=messages, **_GPT_PARAMS,
     )
     return resp.choices[0].message.content.strip()
 
-# ────────────────────── GPT REPLY ───────────────────────────
-def generate_reply(user_id: str, text: str) -> str:
-    user   = get_or_create_user(user_id)
-    soc    = user["social_battery"]
-    energy = user["energy"]
+async def _call_gpt_async(messages: list[dict], temperature: float = 0.92) -> str:
+    resp = await openai_aclient.chat.completions.create(
+        temperature=temperature, messages=messages, **_GPT_PARAMS,
+    )
+    return resp.choices[0].message.content.strip()
 
-    # FIX #6: persist user message BEFORE building history for GPT
-    # so get_history() already contains the current turn
-    append_history(user_id, "user", text)
+# ────────────────────── GPT REPLY ───────────────────────────
+def _typing_delay(state: dict, text: str) -> float:
+    """Human-like typing delay (seconds) before the reply is pushed."""
+    soc    = state["social_battery"]
+    energy = state["energy"]
 
-    # Human-like typing delay
     base = 1.5 + len(text) * 0.03
     if soc < 40:
         delay = base + random.uniform(5, 9)
@@ -436,23 +693,47 @@ def generate_reply(user_id: str, text: str) -> str:
         delay = base + random.uniform(3, 6)
     else:
         delay = base + random.uniform(1, 3)
-    time.sleep(min(delay, 12))
+    return min(delay, 12)
 
-    system_prompt = build_system_prompt(user_id)
-    history       = get_history(user_id)   # includes current user message
+def _reply_messages(user_id: str) -> list[dict]:
+    # FIX #6: the user message was already persisted by handle_message
+    # (inside its transaction), so get_history() contains the current turn
+    messages = [{"role": "system", "content": build_system_prompt(user_id)}]
+    messages.extend(get_history(user_id))   # includes current user message
+    return messages
 
-    messages = [{"role": "system", "content": system_prompt}]
-    messages.extend(history)
+async def generate_reply(user_id: str) -> str:
+    # SQLite work stays on executor threads; only the OpenAI request is awaited
+    # on the loop, so no thread is held for the length of the API call.
+    loop     = asyncio.get_running_loop()
+    messages = await loop.run_in_executor(_reply_executor, _reply_messages, user_id)
 
     try:
-        reply = _call_gpt(messages)
+        reply = await _call_gpt_async(messages)
     except Exception as e:
         log.error("GPT error for user %s: %s", user_id, e)
         reply = "โทษทีนะ สัญญาณหายไปแป๊บ"
 
-    append_history(user_id, "assistant", reply)
+    await loop.run_in_executor(_reply_executor, append_history, user_id, "assistant", reply)
     return reply
 
+# ───────────────────── DEFERRED REPLIES ─────────────────────
+# Typing delays and GPT requests are awaited on one asyncio loop (created at
+# STARTUP); blocking SQLite / LINE work goes to a bounded executor
+_reply_loop: asyncio.AbstractEventLoop | None = None
+_reply_executor = ThreadPoolExecutor(max_workers=REPLY_WORKERS, thread_name_prefix="reply")
+
+async def _delayed_reply(user_id: str, delay: float):
+    await asyncio.sleep(delay)
+    # FIX #3: a push (unlike a reply token) has no TTL — safe after a long delay
+    try:
+        reply = await generate_reply(user_id)
+        await asyncio.get_running_loop().run_in_executor(
+            _reply_executor, line_push, user_id, reply,
+        )
+    except Exception as e:
+        log.error("Reply failed for %s: %s", user_id, e)
+
 # ──────────────── PROACTIVE GPT MESSAGES ────────────────────
 _PROACTIVE_PROMPTS = {
     "morning": "เขียนข้อความ LINE สั้น ๆ (1-2 ประโยค) จากม่อนถึงฟ้า ตอนเช้า เป็นห่วง ทักทาย ไม่ต้องสมบูรณ์ ภาษาไทยไม่เป็นทางการ อย่าดูเหมือน AI",
@@ -476,9 +757,18 @@ def generate_proactive_message(moment: str) -> str:
         return _PROACTIVE_FALLBACKS[moment]
 
 # ─────────────────── LINE WEBHOOK ───────────────────────────
-@app.route("/")
+# "/" is polled by uptime monitors: one prebuilt response, no access-log line
+_HEALTH_RESPONSE = Response(b"Bot is running", status=200, mimetype="text/plain")
+
+class _HealthCheckLogFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        return '"GET / ' not in record.getMessage()
+
+logging.getLogger("werkzeug").addFilter(_HealthCheckLogFilter())
+
+@app.route("/", methods=["GET"])
 def home():
-    return "Bot is running", 200
+    return _HEALTH_RESPONSE
 
 @app.route("/callback", methods=["POST"])
 def callback():
@@ -495,18 +785,19 @@ def handle_message(event):
     user_id = event.source.user_id
     text    = event.message.text
 
-    adjust_emotion(user_id, text)
-    save_memory(user_id, text)
+    style = get_attachment(user_id)   # cached; must not run inside tx() below
 
-    # FIX #3: push_message has no TTL — safe to call after long delay
-    def _reply():
-        try:
-            reply = generate_reply(user_id, text)
-            line_bot_api.push_message(user_id, TextSendMessage(text=reply))
-        except Exception as e:
-            log.error("Reply failed for %s: %s", user_id, e)
+    # One transaction for all per-message writes: a single commit instead of one each
+    with tx() as c:
+        user  = get_or_create_user(user_id, c)   # one users lookup, under the write lock
+        hits  = scan_keywords(text)   # one pass, shared by both below
+        state = adjust_emotion(user, style, text, c, hits)
+        save_memory(user_id, text, c, hits)
+        # FIX #6: persist user message BEFORE building history for GPT
+        append_history(user_id, "user", text, c)
+        delay = _typing_delay(state, text)
 
-    threading.Thread(target=_reply, daemon=True).start()
+    asyncio.run_coroutine_threadsafe(_delayed_reply(user_id, delay), _reply_loop)
 
 # ───────────────────────── SCHEDULER ────────────────────────
 _SCHEDULE = [
@@ -516,74 +807,149 @@ _SCHEDULE = [
     (23, 23, 50, 59, "night",   "last_night"),
 ]
 
+_ENERGY_RECOVERY_WINDOW = (5, 5, 0, 4)   # FIX #5: 05:00–05:04
+
 def _should_send(hour: int, minute: int, h_s: int, h_e: int, m_s: int, m_e: int) -> bool:
     return h_s <= hour <= h_e and m_s <= minute <= m_e
 
+def _seconds_until_next_wake(now: datetime.datetime) -> float:
+    """Seconds until the next window opens; 60 inside one, so failed pushes retry."""
+    windows = [w[:4] for w in _SCHEDULE] + [_ENERGY_RECOVERY_WINDOW]
+    if any(_should_send(now.hour, now.minute, *w) for w in windows):
+        return 60
+
+    starts = []
+    for h_s, _, m_s, _ in windows:
+        # Asia/Bangkok has no DST, so replace() on the aware datetime is safe
+        start = now.replace(hour=h_s, minute=m_s, second=0, microsecond=0)
+        if start <= now:
+            start += datetime.timedelta(days=1)
+        starts.append(start)
+    # At least 1s: a sleep that returns a hair early must not spin
+    return max((min(starts) - now).total_seconds(), 1)
+
 def _recover_energy_all_users():
     """FIX #5: restore energy & social_battery so bot isn't permanently depleted."""
-    db_execute("""
-        UPDATE users
-        SET energy         = MIN(energy + 30, 100),
-            social_battery = MIN(social_battery + 20, 100)
-    """)
-    log.info("Overnight energy recovery applied to all users")
-
-def scheduler():
-    # FIX #2: filelock — only one Gunicorn worker runs the scheduler
-    lock = filelock.FileLock(SCHEDULER_LOCK_PATH)
+    # Users already at full energy and battery are skipped — no page write for them
+    with tx() as c:
+        cur = c.execute("""
+            UPDATE users
+            SET energy         = MIN(energy + 30, 100),
+                social_battery = MIN(social_battery + 20, 100)
+            WHERE energy < 100 OR social_battery < 100
+        """)
+    log.info("Overnight energy recovery applied to %d users", cur.rowcount)
+
+def _optimize_db():
+    """Re-ANALYZE the tables whose planner statistics SQLite deems stale."""
+    with tx() as c:
+        c.execute("PRAGMA optimize")
+    log.info("SQLite PRAGMA optimize applied")
+
+# Chunks of one window are sent concurrently; bounded so a large user base
+# cannot open an unbounded number of connections to LINE / OpenAI
+_push_executor = ThreadPoolExecutor(max_workers=PUSH_WORKERS, thread_name_prefix="push")
+
+def _broadcast_chunk(moment: str, msg: str, chunk: list[str]) -> list[str]:
+    """Multicast msg to one chunk; return the users it reached."""
+    # A failed chunk must not abort the others — they are retried next wake
     try:
-        lock.acquire(timeout=0)
-    except filelock.Timeout:
-        log.info("Scheduler lock held by another worker — this worker will skip")
-        return
+        line_multicast(chunk, msg)
+    except Exception as e:
+        log.error("Multicast failed (%s → %d users): %s", moment, len(chunk), e)
+        return []
+    log.info("Sent %s message to %d users", moment, len(chunk))
+    return chunk
 
-    log.info("Scheduler acquired lock and started")
+def scheduler():
+    log.info("Scheduler started")
     energy_recovered_today: str | None = None
 
     while True:
         try:
             now   = datetime.datetime.now(TZ)
-            today = now.strftime("%Y-%m-%d")
+            today = now.date().isoformat()   # "%Y-%m-%d", computed once per tick
             h, m  = now.hour, now.minute
 
             # FIX #5: recover energy once per day at 05:00
-            if h == 5 and m < 5 and energy_recovered_today != today:
+            if _should_send(h, m, *_ENERGY_RECOVERY_WINDOW) and energy_recovered_today != today:
                 _recover_energy_all_users()
+                _optimize_db()
                 energy_recovered_today = today
 
-            rows = db_fetchall(
-                "SELECT user_id, last_morning, last_night, last_random FROM users"
-            )
-
-            for row in rows:
-                uid = row["user_id"]
-                field_values = {
-                    "last_morning": row["last_morning"],
-                    "last_night":   row["last_night"],
-                    "last_random":  row["last_random"],
-                }
-
-                for h_s, h_e, m_s, m_e, moment, field in _SCHEDULE:
-                    if _should_send(h, m, h_s, h_e, m_s, m_e) and field_values[field] != today:
-                        msg = generate_proactive_message(moment)
-                        try:
-                            line_bot_api.push_message(uid, TextSendMessage(text=msg))
-                            # field name comes from our own _SCHEDULE constant — safe
-                            db_execute(
-                                f"UPDATE users SET {field}=? WHERE user_id=?",
-                                (today, uid),
-                            )
-                            log.info("Sent %s message to %s", moment, uid)
-                        except Exception as e:
-                            log.error("Push failed (%s → %s): %s", moment, uid, e)
+            for h_s, h_e, m_s, m_e, moment, field in _SCHEDULE:
+                if not _should_send(h, m, h_s, h_e, m_s, m_e):
+                    continue
+
+                # Not yet pinged today: '' or an earlier ISO date, an index range;
+                # field name comes from our own _SCHEDULE constant — safe
+                rows = db_fetchall(f"SELECT user_id FROM users WHERE {field} < ?", (today,))
+                uids = [row["user_id"] for row in rows]
+
+                if not uids:
+                    continue
+
+                # One GPT message per window, multicast to chunks in parallel;
+                # delivered users are then marked in a single transaction
+                msg    = generate_proactive_message(moment)
+                chunks = [uids[i:i + LINE_MULTICAST_MAX]
+                          for i in range(0, len(uids), LINE_MULTICAST_MAX)]
+                n      = len(chunks)
+                delivered: list[str] = []
+                for sent in _push_executor.map(_broadcast_chunk, [moment] * n, [msg] * n, chunks):
+                    delivered.extend(sent)
+
+                if delivered:
+                    with tx() as c:
+                        c.executemany(
+                            f"UPDATE users SET {field}=? WHERE user_id=?",
+                            [(today, uid) for uid in delivered],
+                        )
 
         except Exception as e:
             log.error("Scheduler loop error: %s", e)
 
-        time.sleep(60)
+        time.sleep(_seconds_until_next_wake(datetime.datetime.now(TZ)))
 
 # ─────────────────────────── STARTUP ────────────────────────
-# Runs at module import — compatible with Gunicorn multi-worker mode
-init_db()
-scheduler_thread = threading.Thread(target=scheduler, daemon=True)
-scheduler_thread.start()
+# Nothing opens the DB or starts threads at import (neither survives fork): each
+# worker calls _startup() from post_worker_init, or failing that on its first request
+_startup_lock  = threading.Lock()
+_started       = False
+_scheduler_lock: filelock.FileLock | None = None
+
+def _try_acquire_scheduler_lock() -> bool:
+    # FIX #2: filelock — only one Gunicorn worker runs the scheduler
+    global _scheduler_lock
+    lock = filelock.FileLock(SCHEDULER_LOCK_PATH)
+    try:
+        lock.acquire(timeout=0)
+    except filelock.Timeout:
+        log.info("Scheduler lock held by another worker — this worker will skip")
+        return False
+    _scheduler_lock = lock   # keep a reference for the life of the process
+    return True
+
+def _startup():
+    global _pool, _reply_loop, _started
+    with _startup_lock:
+        if _started:
+            return
+        # Steps already done are kept: a failed startup resumes on the next
+        # request without a second pool or thread
+        if _pool is None:
+            _pool = SQLitePool(DB_PATH, readers=DB_READERS)
+        init_db()
+        if _reply_loop is None:
+            _reply_loop = asyncio.new_event_loop()
+            threading.Thread(target=_reply_loop.run_forever, daemon=True).start()
+        # Only the lock holder even creates the scheduler thread
+        if _try_acquire_scheduler_lock():
+            threading.Thread(target=scheduler, daemon=True).start()
+        _started = True
+
+# Flask 2.3 removed before_first_request; a once-guarded before_request does the same
+@app.before_request
+def _startup_once():
+    if not _started:
+        _startup()